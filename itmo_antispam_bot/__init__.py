@@ -1 +1,2 @@
 from itmo_antispam_bot.rubert_bot import TelegramSpamBot
+from itmo_antispam_bot.spam_detector import SpamDetector
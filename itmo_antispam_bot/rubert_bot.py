@@ -1,9 +1,10 @@
 import asyncio
+import contextlib
+import heapq
 import logging
 import os
-import re
+import time
 
-import torch
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.constants import ChatMemberStatus
@@ -14,7 +15,11 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
-from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+if __package__:
+    from itmo_antispam_bot.spam_detector import SpamDetector, limit_torch_threads
+else:  # Run as a script, with the package directory on sys.path
+    from spam_detector import SpamDetector, limit_torch_threads
 
 load_dotenv()
 
@@ -25,81 +30,33 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-class SpamDetector:
-    """
-    A class responsible for detecting spam messages using a machine learning model.
-    """
-
-    def __init__(self, model_name: str):
-        """
-        Initialize the SpamDetector with the specified model.
-        """
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = (
-            AutoModelForSequenceClassification.from_pretrained(model_name, num_labels=1)
-            .to(self.device)
-            .eval()
-        )
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-
-    @staticmethod
-    def _clean_text(text: str) -> str:
-        """
-        Clean and normalize the input text for spam detection.
-        """
-        # Remove URLs
-        text = re.sub(r"http\S+", "", text)
-        return text
-
-    def classify_message(self, message: str) -> bool:
-        """
-        Classify the message as spam or not spam.
-
-        Returns:
-            bool: True if the message is spam, False otherwise.
-        """
-        try:
-            message = self._clean_text(message)
-            encoding = self.tokenizer(
-                message,
-                padding="max_length",
-                truncation=True,
-                max_length=128,
-                return_tensors="pt",
-            )
-            input_ids = encoding["input_ids"].to(self.device)
-            attention_mask = encoding["attention_mask"].to(self.device)
-
-            with torch.no_grad():
-                outputs = self.model(input_ids, attention_mask=attention_mask).logits
-                pred = torch.sigmoid(outputs).cpu().numpy()[0][0]
-
-            is_spam = pred >= 0.5
-            logger.debug(
-                f"Message classified as {'spam' if is_spam else 'not spam'} with score {pred:.4f}"
-            )
-            return is_spam
-        except Exception as e:
-            logger.error(f"Error in classify_message: {e}")
-            return False  # Default to not spam if there's an error
-
-
 class TelegramSpamBot:
     """
     A Telegram bot that detects and removes spam messages from new users.
     """
 
-    def __init__(self, token: str, model_name: str):
+    def __init__(self, token: str, model_name: str, onnx_path: str | None = None):
         """
         Initialize the TelegramSpamBot.
 
         Args:
             token (str): The bot's API token.
             model_name (str): The name of the spam detection model.
-        """
-        self.application = ApplicationBuilder().token(token).build()
-        self.spam_detector = SpamDetector(model_name)
-        self.new_members = {}
+            onnx_path (str | None): Optional ONNX export of the model for CPU inference.
+        """
+        # Process updates concurrently so pending messages can share a batch
+        self.application = (
+            ApplicationBuilder()
+            .token(token)
+            .concurrent_updates(True)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
+        self.spam_detector = SpamDetector(model_name, onnx_path=onnx_path)
+        self.new_members: dict[int, float] = {}  # User ID -> tracking expiry time
+        self._expiry_heap: list[tuple[float, int]] = []
+        self._expiry_added = asyncio.Event()
+        self._cleanup_task = None
         self.cleanup_interval = 2628002  # Time in seconds to track new users
 
         self._setup_handlers()
@@ -122,6 +79,17 @@ class TelegramSpamBot:
         logger.info("Starting the bot...")
         self.application.run_polling(allowed_updates=["message", "chat_member"])
 
+    async def _post_shutdown(self, application):
+        """
+        Stop background tasks once the application has shut down.
+        """
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._cleanup_task
+            self._cleanup_task = None
+
+        await self.spam_detector.close()
 
     async def track_chat_member_updates(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -129,20 +97,38 @@ class TelegramSpamBot:
             if status == ChatMemberStatus.MEMBER:
                 user = update.chat_member.new_chat_member.user
                 user_id = user.id
-                self.new_members[user_id] = True
+                if self._cleanup_task is None:
+                    self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+                if user_id not in self.new_members:
+                    expiry = time.monotonic() + self.cleanup_interval
+                    self.new_members[user_id] = expiry
+                    heapq.heappush(self._expiry_heap, (expiry, user_id))
+                    self._expiry_added.set()
                 logger.info(f"New member joined: {user.full_name} (ID: {user_id}) via chat_member update.")
-                context.application.create_task(
-                    self.remove_user_after_delay(user_id)
-                )
         except Exception as e:
             logger.error(f"Error in track_chat_member_updates: {e}")
 
-    async def remove_user_after_delay(self, user_id: int):
+    async def _cleanup_loop(self):
         """
-        Remove the user from tracking after a delay.
+        Remove users from tracking once their tracking period expires.
         """
-        await asyncio.sleep(self.cleanup_interval)
-        await self.remove_user_from_new_members(user_id)
+        while True:
+            if not self._expiry_heap:
+                self._expiry_added.clear()
+                await self._expiry_added.wait()
+                continue
+
+            expiry, user_id = self._expiry_heap[0]
+            delay = expiry - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(self._expiry_heap)
+            # Skip stale entries left behind by users who were removed and rejoined
+            if self.new_members.get(user_id) == expiry:
+                await self.remove_user_from_new_members(user_id)
 
     async def remove_user_from_new_members(self, user_id: int):
         """
@@ -165,8 +151,12 @@ class TelegramSpamBot:
             chat_id = update.message.chat_id
             message = update.message.text
 
-            if self.new_members.get(user_id):
-                is_spam = self.spam_detector.classify_message(message)
+            if user_id in self.new_members:
+                # Stop tracking before awaiting the verdict, so that only the
+                # first message is checked when updates run concurrently
+                await self.remove_user_from_new_members(user_id)
+
+                is_spam = await self.spam_detector.classify_message(message)
                 if is_spam:
                     # Delete the message and ban the user
                     await context.bot.delete_message(
@@ -176,9 +166,6 @@ class TelegramSpamBot:
                     logger.warning(f"Banned user {user_id} for spam.")
                 else:
                     logger.info(f"User {user_id} passed spam check.")
-
-                # Remove the user from tracking after their first message
-                await self.remove_user_from_new_members(user_id)
         except Exception as e:
             logger.error(f"Error in check_first_message: {e}")
 
@@ -189,6 +176,7 @@ if __name__ == "__main__":
     # Retrieve the bot token from the environment variable
     BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
     MODEL_NAME = "NeuroSpaceX/ruSpamNS_v6"
+    ONNX_PATH = os.environ.get("SPAM_MODEL_ONNX_PATH")
 
     if not BOT_TOKEN:
         logger.critical(
@@ -197,7 +185,11 @@ if __name__ == "__main__":
         exit(1)
 
     try:
-        bot = TelegramSpamBot(token=BOT_TOKEN, model_name=MODEL_NAME)
+        # Keep each forward single-threaded so concurrent requests don't oversubscribe
+        limit_torch_threads()
+        bot = TelegramSpamBot(
+            token=BOT_TOKEN, model_name=MODEL_NAME, onnx_path=ONNX_PATH
+        )
         bot.start()
     except Exception as error:
         logger.critical(f"Unhandled exception: {error}")
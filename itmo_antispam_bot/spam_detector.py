@@ -0,0 +1,374 @@
+import asyncio
+import contextlib
+import logging
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+try:
+    import onnxruntime
+except ImportError:  # ONNX Runtime is an optional CPU backend
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+_URL_RE = re.compile(r"http\S+")
+
+
+def limit_torch_threads(num_threads: int = 1):
+    """
+    Limit the number of CPU threads PyTorch uses for each forward pass.
+
+    Should be called at startup, before any other PyTorch work is done.
+    """
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_threads)
+    except RuntimeError as e:
+        # Only possible before any inter-op parallel work has started
+        logger.warning(f"Could not limit PyTorch inter-op threads: {e}")
+
+
+class SpamDetector:
+    """
+    A class responsible for detecting spam messages using a machine learning model.
+    """
+
+    MIN_LENGTH = 4  # Messages shorter than this are never classified as spam
+    MAX_LENGTH = 128  # Maximum number of tokens per message
+    MAX_BATCH = 16  # Maximum number of messages per forward pass
+    BATCH_WINDOW = 0.01  # Time in seconds to wait for a batch to fill up
+    CACHE_SIZE = 4096  # Number of recent verdicts kept for repeated messages
+    # Padded input shapes on CUDA, so a CUDA graph is recorded per bucket only
+    BATCH_BUCKETS = (1, 2, 4, 8, MAX_BATCH)
+    SEQUENCE_BUCKETS = (16, 32, 64, MAX_LENGTH)
+
+    __slots__ = (
+        "device",
+        "model",
+        "tokenizer",
+        "_session",
+        "_pinned_input_ids",
+        "_pinned_attention_mask",
+        "_queue",
+        "_worker",
+        "_executor",
+        "_cache",
+    )
+
+    def __init__(self, model_name: str, onnx_path: str | None = None):
+        """
+        Initialize the SpamDetector with the specified model.
+
+        Args:
+            model_name (str): The name of the spam detection model.
+            onnx_path (str | None): Path of an ONNX export of the model to run
+                with ONNX Runtime on CPU. Exported on first use if missing.
+        """
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Load weights straight onto the target device in their serving dtype;
+        # CPU stays fp32 for quantization and ONNX export
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            model_name,
+            num_labels=1,
+            torch_dtype=torch.float16 if self.device.type == "cuda" else torch.float32,
+            low_cpu_mem_usage=True,
+            device_map={"": self.device},
+        ).eval()
+
+        self._session = None
+        if self.device.type == "cpu" and onnx_path:
+            if onnxruntime is None:
+                logger.warning("onnxruntime is not installed, falling back to PyTorch.")
+            else:
+                try:
+                    self._session = self._create_onnx_session(onnx_path)
+                    # The session holds its own copy of the weights
+                    self.model = None
+                except Exception as e:
+                    logger.warning(
+                        f"Could not set up ONNX Runtime, falling back to PyTorch: {e}"
+                    )
+
+        if self.device.type == "cpu" and self._session is None:
+            # Int8 weights for linear layers, activations quantized on the fly
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+        # Pinned staging buffers for asynchronous host-to-device copies
+        self._pinned_input_ids = None
+        self._pinned_attention_mask = None
+        if self.device.type == "cuda":
+            self._pinned_input_ids = torch.empty(
+                self.MAX_BATCH * self.MAX_LENGTH, dtype=torch.long, pin_memory=True
+            )
+            self._pinned_attention_mask = torch.empty(
+                self.MAX_BATCH * self.MAX_LENGTH, dtype=torch.long, pin_memory=True
+            )
+
+        self._queue = asyncio.Queue()
+        self._worker = None
+        # A single thread owns the model, keeping forwards off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._cache: OrderedDict[str, bool] = OrderedDict()
+
+        if self.device.type == "cuda":
+            self.model = torch.compile(self.model, mode="reduce-overhead", dynamic=True)
+        elif self._session is None:
+            # Separate tensors, or the tracer binds both inputs to the same value
+            input_ids = torch.ones((1, self.MAX_LENGTH), dtype=torch.long)
+            attention_mask = torch.ones((1, self.MAX_LENGTH), dtype=torch.long)
+            with torch.no_grad():
+                traced = torch.jit.trace(
+                    self.model, (input_ids, attention_mask), strict=False
+                )
+                self.model = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+        # Absorb compilation, CUDA graph recording and JIT profiling cost
+        # before serving any messages
+        for _ in range(3):
+            if self.device.type == "cuda":
+                for batch_size in self.BATCH_BUCKETS:
+                    for length in self.SEQUENCE_BUCKETS:
+                        self._executor.submit(
+                            self._warm_up_bucket, batch_size, length
+                        ).result()
+            else:
+                self._executor.submit(self._predict_batch, ["warm-up"]).result()
+
+    def _create_onnx_session(self, onnx_path: str):
+        """
+        Create an ONNX Runtime session for the model, exporting it first if needed.
+        """
+        if not os.path.exists(onnx_path):
+            logger.info(f"Exporting the spam detection model to {onnx_path}...")
+            # Separate tensors, or the exporter treats both inputs as one
+            input_ids = torch.ones((1, self.MAX_LENGTH), dtype=torch.long)
+            attention_mask = torch.ones((1, self.MAX_LENGTH), dtype=torch.long)
+            with torch.no_grad():
+                torch.onnx.export(
+                    self.model,
+                    (input_ids, attention_mask),
+                    onnx_path,
+                    input_names=["input_ids", "attention_mask"],
+                    output_names=["logits"],
+                    dynamic_axes={
+                        "input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "logits": {0: "batch"},
+                    },
+                    opset_version=17,
+                )
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        return onnxruntime.InferenceSession(
+            onnx_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    @staticmethod
+    def _clean_text(text: str) -> str:
+        """
+        Clean and normalize the input text for spam detection.
+        """
+        # Remove URLs
+        text = _URL_RE.sub("", text)
+        return text
+
+    async def close(self):
+        """
+        Stop the batch worker and the inference thread.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._worker
+            self._worker = None
+
+        # Waits for a forward that is already running, at most one batch
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    async def classify_message(self, message: str) -> bool:
+        """
+        Classify the message as spam or not spam.
+
+        Messages are queued and classified in batches by a background worker,
+        so concurrent calls share a single forward pass. Verdicts are cached,
+        so spam pasted from many accounts is classified only once.
+
+        Returns:
+            bool: True if the message is spam, False otherwise.
+        """
+        try:
+            # Skip the model for greetings, emojis and other trivial messages
+            text = message.strip()
+            if len(text) < self.MIN_LENGTH or not any(char.isalnum() for char in text):
+                return False
+
+            if self._worker is None:
+                self._worker = asyncio.create_task(self._batch_worker())
+
+            message = self._clean_text(message)
+            if message in self._cache:
+                self._cache.move_to_end(message)
+                return self._cache[message]
+
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((message, future))
+            is_spam = await future
+
+            self._cache[message] = is_spam
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return is_spam
+        except Exception as e:
+            logger.error(f"Error in classify_message: {e}")
+            return False  # Default to not spam if there's an error
+
+    async def _batch_worker(self):
+        """
+        Drain the queue and classify pending messages in batches.
+
+        A batch is closed once it holds MAX_BATCH messages or BATCH_WINDOW
+        seconds have passed since its first message arrived.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.BATCH_WINDOW
+            while len(batch) < self.MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            messages = [message for message, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._predict_batch, messages
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), is_spam in zip(batch, results):
+                if not future.done():
+                    future.set_result(is_spam)
+
+    @staticmethod
+    def _bucket(size: int, buckets: tuple[int, ...]) -> int:
+        """
+        Return the smallest bucket that fits the given size.
+        """
+        return next(bucket for bucket in buckets if bucket >= size)
+
+    def _to_device(
+        self, tensor: torch.Tensor, pinned: torch.Tensor | None, pad_value: int
+    ) -> torch.Tensor:
+        """
+        Move a token tensor to the model device, staging it in pinned memory if available.
+
+        Staged tensors are padded up to the nearest batch and sequence bucket.
+        """
+        if pinned is None:
+            return tensor.to(self.device)
+
+        batch_size, length = tensor.shape
+        shape = (
+            self._bucket(batch_size, self.BATCH_BUCKETS),
+            self._bucket(length, self.SEQUENCE_BUCKETS),
+        )
+        # A flat buffer keeps the staged view contiguous for any batch shape
+        staging = pinned[: shape[0] * shape[1]].view(shape)
+        staging.fill_(pad_value)
+        staging[:batch_size, :length].copy_(tensor)
+        return staging.to(self.device, non_blocking=True)
+
+    def _warm_up_bucket(self, batch_size: int, length: int):
+        """
+        Run a forward pass on dummy inputs staged exactly as real batches are.
+        """
+        tokens = torch.ones((batch_size, length), dtype=torch.long)
+        input_ids = self._to_device(
+            tokens, self._pinned_input_ids, self.tokenizer.pad_token_id
+        )
+        attention_mask = self._to_device(
+            torch.ones_like(tokens), self._pinned_attention_mask, 0
+        )
+        self._forward(input_ids, attention_mask)
+
+    def _forward(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Run the PyTorch model and return the spam logit of every row.
+        """
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.float16,
+            enabled=self.device.type == "cuda",
+        ):
+            return self.model(input_ids, attention_mask=attention_mask)["logits"][:, 0]
+
+    def _predict_batch(self, messages: list[str]) -> list[bool]:
+        """
+        Run a single forward pass over a batch of cleaned messages.
+
+        Returns:
+            list[bool]: Spam verdict for each message, in input order.
+        """
+        encoding = self.tokenizer(
+            messages,
+            padding=True,
+            truncation=True,
+            max_length=self.MAX_LENGTH,
+            return_tensors="pt",
+        )
+
+        if self._session is not None:
+            outputs = self._session.run(
+                ["logits"],
+                {
+                    "input_ids": encoding["input_ids"].numpy(),
+                    "attention_mask": encoding["attention_mask"].numpy(),
+                },
+            )[0]
+            logits = outputs[:, 0].tolist()
+        else:
+            input_ids = self._to_device(
+                encoding["input_ids"],
+                self._pinned_input_ids,
+                self.tokenizer.pad_token_id,
+            )
+            attention_mask = self._to_device(
+                encoding["attention_mask"], self._pinned_attention_mask, 0
+            )
+            # Drop the rows added to fill the batch bucket
+            logits = self._forward(input_ids, attention_mask)[: len(messages)].tolist()
+
+        results = []
+        for logit in logits:
+            # sigmoid(logit) >= 0.5 exactly when logit >= 0
+            is_spam = logit >= 0.0
+            logger.debug(
+                f"Message classified as {'spam' if is_spam else 'not spam'} with logit {logit:.4f}"
+            )
+            results.append(is_spam)
+        return results